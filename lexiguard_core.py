@@ -1,17 +1,126 @@
 # -*- coding: utf-8 -*-
 
 
+import io
 import os
 import re
-import json
-from typing import List, Dict, Optional
-
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import orjson
+import pdfplumber
+import pymupdf
 import requests
+from requests.adapters import HTTPAdapter
 
 
 FULL_ENDPOINT = "https://api-gateway.netdb.csie.ncku.edu.tw/api/generate"
 MODEL_NAME = "gpt-oss:20b"
 
+# 同時送出的 LLM 請求上限（每個條款的分析彼此獨立，瓶頸在網路與模型延遲）
+MAX_CONCURRENCY = 8
+# 上游閘道的速率上限（每分鐘請求數），含重試
+REQUESTS_PER_MINUTE = 100
+# 分析指令的版本；修改 CLAUSE_SYSTEM_PROMPT / BATCH_SYSTEM_PROMPT 或快取 key 的算法時要遞增，讓舊的快取結果失效
+PROMPT_VERSION = 3
+# 條款分析結果與追問紀錄的 SQLite 檔（明文），跨行程重啟保留；設為空字串則分析結果只用記憶體快取，
+# 追問紀錄寫入用完即丟的暫存資料庫
+CACHE_PATH = os.environ.get("LEXIGUARD_CACHE_PATH", ".lexiguard_cache.sqlite3")
+# 每次請求打包的條款數：共用一次指令與往返，但太大會拉長單次回應時間
+BATCH_SIZE = 5
+
+# PDF 抽取後端：預設 PyMuPDF（C 實作，純文字抽取快很多）；
+# 表格多、需要 pdfplumber 版面分析的合約可設定 LEXIGUARD_PDF_BACKEND=pdfplumber
+PDF_BACKEND = os.environ.get("LEXIGUARD_PDF_BACKEND", "pymupdf")
+# pdfplumber 後端頁數達此門檻才以多個行程平行抽取文字（pdfminer 為純 Python，受 GIL 限制，執行緒無效）
+PDF_PARALLEL_MIN_PAGES = 16
+# PyMuPDF 每頁只要幾毫秒，頁數要多到足以抵銷開行程的成本才平行
+PDF_PYMUPDF_PARALLEL_MIN_PAGES = 128
+PDF_MAX_WORKERS = 8
+
+# 暫時性錯誤（連線失敗、逾時、429/5xx）的重試設定，等待時間為指數退避加上隨機抖動
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+ANALYSIS_FIELDS = ["summary", "risk_level", "risk_type", "risk_reason", "suggestion"]
+
+# 分析指令精簡成欄位範本 + 一行規則；透過 Ollama 的 system 欄位送出，
+# 每次請求的前綴完全相同，伺服器端可重用這段 prompt 的 KV cache
+_ANALYSIS_RULES = (
+    "所有值用繁體中文（不得有英文句子或簡體字）；risk_level 只能是 低/中/高；"
+    "risk_type 為簡短分類，如「自動續約風險」「責任限制」「資料隱私」。\n"
+)
+
+CLAUSE_SYSTEM_PROMPT = (
+    "你是協助一般民眾閱讀合約的法律顧問。"
+    "只輸出一個可被 json.loads 解析的 JSON 物件，不要其他文字、Markdown 或反引號：\n"
+    '{"summary":"","risk_level":"","risk_type":"","risk_reason":"","suggestion":""}\n'
+    f"{_ANALYSIS_RULES}"
+)
+
+BATCH_SYSTEM_PROMPT = (
+    "你是協助一般民眾閱讀合約的法律顧問。"
+    '輸入為多個 <clause id="編號">條款</clause>，請逐條分析。'
+    "只輸出一個可被 json.loads 解析的 JSON 陣列，每條一個物件、id 與輸入相同，不要其他文字、Markdown 或反引號：\n"
+    '[{"id":1,"summary":"","risk_level":"","risk_type":"","risk_reason":"","suggestion":""}]\n'
+    f"{_ANALYSIS_RULES}"
+)
+
+_VALID_RISK_LEVELS = ("低", "中", "高")
+
+# 追問用的固定指令；條款／總結等同一段對話不變的內容放在 prompt 前段，
+# 追問紀錄與問題放最後，連續追問時前綴相同，可重用伺服器端的 prompt cache
+FOLLOWUP_CLAUSE_SYSTEM_PROMPT = (
+    "你是合約風險說明助理，面向一般民眾。\n"
+    "你只能根據我提供的『條款原文』與『系統分析結果』回答，不可憑空補條款。\n"
+    "一律使用繁體中文，不得出現英文句子或簡體字。\n"
+    "禁止使用『一定違法』『保證無效』等斷言，只能用『可能涉及』『可能有風險』。\n"
+    "回答要具體可操作：\n"
+    "- 若使用者問原因：請用「依本條…」引用條款內容說明。\n"
+    "- 若使用者問怎麼改：請提供可直接替換的條款示例文字（繁體中文）。\n"
+    "- 若資訊不足：請清楚指出缺少什麼資訊，並列出要補的資料。\n"
+    "請直接回答（不要 JSON、不要 Markdown）。\n"
+)
+
+FOLLOWUP_GLOBAL_SYSTEM_PROMPT = (
+    "你是合約風險說明助理，面向一般民眾。\n"
+    "你只能依據我提供的『總結資訊』與『高風險條款摘要』回答，不可憑空補合約內容。\n"
+    "一律使用繁體中文，不得出現英文句子或簡體字。\n"
+    "禁止使用『一定違法』『保證無效』等斷言，只能用『可能涉及』『可能有風險』。\n"
+    "回答請以條列方式，並給出可執行的下一步（例如談判優先順序、要補齊的資訊）。\n"
+    "請直接回答（不要 JSON、不要 Markdown）。\n"
+)
+
+# 預先編譯的 regex（切分時每一行都會用到）
+_RE_ARTICLE = re.compile(r'第\s*[一二三四五六七八九十0-9]+\s*條')
+_RE_CHINESE_NUM = re.compile(r'^[一二三四五六七八九十]+\s*[、．.]', re.M)
+_RE_ARABIC_NUM = re.compile(r'\d+\s*[\.．]')
+_RE_PAREN_NUM = re.compile(r'[（(]?\s*[一二三四五六七八九十0-9]+\s*[)）]')
+_RE_NON_HAN = re.compile(r'[^\u4e00-\u9fff]+')
+# 條款開頭的編號（「第三條」「一、」「1.」「(1)」等，即各種條款開頭規則的聯集），比對條款內容時先去掉
+_RE_CLAUSE_HEADING = re.compile(
+    r'\s*(?:' + _RE_ARTICLE.pattern
+    + r'|[一二三四五六七八九十]+\s*[、．.]'
+    + r'|\d+\s*[\.．](?!\d)'
+    + r'|' + _RE_PAREN_NUM.pattern + r')\s*'
+)
+# 帶單位的數量（期限、金額、比例、倍數…），不含「第三人」「一切」「唯一」這類字裡的國字
+_RE_QUANTITY = re.compile(
+    r'(?:[0-9０-９]+(?:[.,．][0-9０-９]+)*|[零一二三四五六七八九十百千萬兩壹貳參肆伍陸柒捌玖拾佰仟]+)'
+    r'\s*(?:個月|小時|分鐘|[年月日天週周元%％倍次期成折])'
+)
+# 否定詞與當事人：「乙方不得請求」與「乙方得請求」、「甲方應」與「乙方應」意思相反
+_RE_POLARITY = re.compile(r'不|非|未|無|甲方|乙方')
+
 # Windows PowerShell:
 #   $env:LEXIGUARD_API_KEY="your key"
 # Linux/macOS:
@@ -19,6 +128,342 @@ MODEL_NAME = "gpt-oss:20b"
 API_KEY = os.environ.get("LEXIGUARD_API_KEY", "")
 
 
+class LLMCache:
+    """
+    條款分析結果的 LRU 快取，key 為 sha256(model + PROMPT_VERSION + 去掉開頭編號的條款原文)，
+    條款被重新編號（例如中間插入一條）後內容沒變仍可命中。
+    有指定 path 時另寫入 SQLite 檔，重新啟動後仍可命中（記憶體未命中才查磁碟）。
+    只存放解析成功的結果；analyze_document 會並行呼叫，因此以 lock 保護。
+    """
+
+    def __init__(self, maxsize: int = 1024, path: Optional[str] = None):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, clause_text: str) -> str:
+        raw = f"{model}\x00{PROMPT_VERSION}\x00{_strip_clause_heading(clause_text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                return dict(value)
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT value FROM analysis WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value = orjson.loads(row[0])
+            self._remember(key, value)
+            return dict(value)
+
+    def set(self, key: str, value: Dict) -> None:
+        with self._lock:
+            self._remember(key, dict(value))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO analysis (key, value) VALUES (?, ?)",
+                    (key, orjson.dumps(value)),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, value: Dict) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+def _strip_clause_heading(clause_text: str) -> str:
+    """去掉條款開頭的編號，只留內容；條款被重新編號後仍視為同一條。"""
+    m = _RE_CLAUSE_HEADING.match(clause_text)
+    return clause_text[m.end():] if m else clause_text
+
+
+class SemanticCache:
+    """
+    近似重複條款的快取：以字元 bigram 向量的 cosine 相似度比對，
+    相似度 >= threshold 即沿用先前的分析結果。
+
+    比對前先去掉條款開頭的編號（同一段制式條款在第三條或第七條都能命中），
+    並以「帶單位的數量」加上依序出現的否定詞／當事人當指紋，指紋不同就不比對，
+    避免「期滿續約 3 年」與「期滿續約 5 年」、「乙方不得請求」與「乙方得請求」被當成同一條。
+    """
+
+    def __init__(self, threshold: float = 0.92, maxsize: int = 1024):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        # fingerprint -> [(key, bigram 向量, 向量長度, 分析結果), ...]
+        self._buckets: Dict[Tuple, List[Tuple[str, Counter, float, Dict]]] = {}
+        self._order: "OrderedDict[str, Tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(text: str) -> Tuple:
+        quantities = tuple(re.sub(r'\s+', '', q) for q in _RE_QUANTITY.findall(text))
+        return quantities, tuple(_RE_POLARITY.findall(text))
+
+    @staticmethod
+    def _vectorize(text: str) -> Tuple[Counter, float]:
+        chars = "".join(ch for ch in text if ch.isalnum())
+        vec = Counter(chars[i:i + 2] for i in range(len(chars) - 1))
+        norm = sum(v * v for v in vec.values()) ** 0.5
+        return vec, norm
+
+    def get(self, clause_text: str) -> Optional[Dict]:
+        clause_text = _strip_clause_heading(clause_text)
+        fp = self._fingerprint(clause_text)
+        vec, norm = self._vectorize(clause_text)
+        if not norm:
+            return None
+
+        with self._lock:
+            best, best_score = None, self.threshold
+            for _, other, other_norm, value in self._buckets.get(fp, []):
+                if len(vec) > len(other):
+                    dot = sum(v * vec[k] for k, v in other.items() if k in vec)
+                else:
+                    dot = sum(v * other[k] for k, v in vec.items() if k in other)
+                score = dot / (norm * other_norm)
+                if score >= best_score:
+                    best, best_score = value, score
+            return dict(best) if best is not None else None
+
+    def set(self, key: str, clause_text: str, value: Dict) -> None:
+        if self.maxsize <= 0:
+            return
+        clause_text = _strip_clause_heading(clause_text)
+        fp = self._fingerprint(clause_text)
+        vec, norm = self._vectorize(clause_text)
+        if not norm:
+            return
+
+        with self._lock:
+            if key in self._order:
+                return
+            self._buckets.setdefault(fp, []).append((key, vec, norm, dict(value)))
+            self._order[key] = fp
+            while len(self._order) > self.maxsize:
+                old_key, old_fp = self._order.popitem(last=False)
+                bucket = [e for e in self._buckets[old_fp] if e[0] != old_key]
+                if bucket:
+                    self._buckets[old_fp] = bucket
+                else:
+                    del self._buckets[old_fp]
+
+
+class ChatStore:
+    """
+    追問紀錄的 SQLite 存檔，重新整理頁面或重啟後仍可接續。
+    key 為 sha256(owner + 合約內容)：owner 區分使用者（web 端用網址上的 ?sid=），
+    同一份合約由不同 owner 上傳時各自獨立，不會看到彼此的問答。
+    scope 區分對話：整份合約的聊天室為 "global"，單條追問為 "clause:<條號>"。
+    """
+
+    def __init__(self, path: str = CACHE_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat ("
+            "contract TEXT NOT NULL, scope TEXT NOT NULL, turns BLOB NOT NULL, "
+            "PRIMARY KEY (contract, scope))"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(owner: str, data: bytes) -> str:
+        return hashlib.sha256(owner.encode("utf-8") + b"\x00" + data).hexdigest()
+
+    def load_all(self, contract: str) -> Dict[str, List[Dict[str, str]]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT scope, turns FROM chat WHERE contract = ?", (contract,)
+            ).fetchall()
+        return {scope: orjson.loads(turns) for scope, turns in rows}
+
+    def save(self, contract: str, scope: str, turns: List[Dict[str, str]]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO chat (contract, scope, turns) VALUES (?, ?, ?)",
+                (contract, scope, orjson.dumps(turns)),
+            )
+            self._db.commit()
+
+
+def _normalize_question(text: str) -> str:
+    # 全形／半形統一後去掉空白與標點，只比對剩下的文字
+    text = unicodedata.normalize("NFKC", text or "")
+    return "".join(ch for ch in text if not unicodedata.category(ch).startswith(("P", "Z", "C")))
+
+
+def find_repeated_answer(question: str, history: List[Dict[str, str]]) -> Optional[str]:
+    """
+    同一段對話裡問過「相同」的問題（忽略空白、標點與全形半形差異）時，回傳最近一次的回答，
+    不必再呼叫 LLM；找不到回傳 None。
+    只比對完全相同的文字：合約問題差一個字（甲方／乙方、「不」）意思就可能相反，不做近似比對。
+    """
+    target = _normalize_question(question)
+    if not target:
+        return None
+    for t in reversed(history):
+        if t.get("a") and _normalize_question(t.get("q", "")) == target:
+            return t["a"]
+    return None
+
+
+class CircuitOpenError(RuntimeError):
+    """上游連續失敗，熔斷中，暫停送出請求。"""
+
+
+class CircuitBreaker:
+    """
+    連續 max_failures 個請求在重試用盡後仍失敗，就斷開 cooldown 秒：
+    期間新的呼叫直接丟出 CircuitOpenError，不再打到上游；
+    已在重試中的請求則以 wait() 等冷卻結束再試。冷卻後放行，成功一次即恢復。
+    429（被限流）不算失敗，不會觸發熔斷。
+    """
+
+    def __init__(self, max_failures: int = 5, cooldown: float = 30.0):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self.cooldown - (time.monotonic() - self._opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(f"LLM 服務連續失敗，暫停呼叫（約 {int(remaining) + 1} 秒後重試）")
+
+    def wait(self) -> None:
+        """熔斷中就等到冷卻結束（給重試中的請求用，不丟例外）。"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self.cooldown - (time.monotonic() - self._opened_at)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                self._opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """
+    執行緒安全的 token bucket：平均每分鐘最多 max_per_minute 次請求，
+    最多允許 burst 次瞬間突發；額度用完時 acquire() 會睡到補足一次額度為止。
+    """
+
+    def __init__(self, max_per_minute: float = REQUESTS_PER_MINUTE, burst: int = MAX_CONCURRENCY):
+        self.rate = max_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _coerce_analysis(parsed) -> Optional[Dict]:
+    """
+    把 LLM 回傳的單筆分析整理成固定欄位：不是物件時回傳 None；
+    只保留 ANALYSIS_FIELDS，缺少的補空字串，其餘值一律轉成字串。
+    """
+    if not isinstance(parsed, dict):
+        return None
+    out = {}
+    for k in ANALYSIS_FIELDS:
+        v = parsed.get(k)
+        out[k] = "" if v is None else str(v)
+    return out
+
+
+def _parse_item_id(value) -> Optional[int]:
+    """批次回傳的 id：接受整數，以及模型照抄 id="1" 而回傳的數字字串 "1"。"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+
+def _format_history(
+    history: Optional[List[Dict[str, str]]],
+    max_turns: int,
+    heading: str,
+    max_summary_turns: int = 10,
+    summary_chars: int = 40,
+) -> str:
+    """
+    把追問紀錄整理成 prompt 片段：最近 max_turns 輪保留完整問答，
+    更早的只留問題摘要（最多 max_summary_turns 條、每條 summary_chars 字），
+    讓對話再長，送出的 prompt 長度也有上限。
+    """
+    turns = []
+    for t in history or []:
+        q = (t.get("q") or "").strip()
+        a = (t.get("a") or "").strip()
+        if q and a:
+            turns.append((q, a))
+    if not turns:
+        return ""
+
+    older, recent = turns[:-max_turns], turns[-max_turns:]
+    parts = []
+    if older:
+        lines = []
+        for q, _ in older[-max_summary_turns:]:
+            q = q.replace("\n", " ")
+            lines.append("- " + (q[:summary_chars] + "..." if len(q) > summary_chars else q))
+        if len(older) > max_summary_turns:
+            lines.insert(0, f"- （另有更早的 {len(older) - max_summary_turns} 個問題略過）")
+        parts.append("【更早的問題摘要】\n" + "\n".join(lines) + "\n")
+    parts.append(
+        f"【{heading}】\n"
+        + "\n\n".join(f"使用者問：{q}\n助理答：{a}" for q, a in recent)
+        + "\n"
+    )
+    return "\n".join(parts)
+
+
 class LLMClient:
     """
     使用 Ollama /api/generate 的簡單 client。
@@ -27,6 +472,7 @@ class LLMClient:
     body:
       {
         "model": "gpt-oss:20b",
+        "system": "...",   # 選填，固定的指令放這裡
         "prompt": "...",
         "stream": false
       }
@@ -37,29 +483,131 @@ class LLMClient:
     def __init__(self,
                  endpoint: str = FULL_ENDPOINT,
                  api_key: str = API_KEY,
-                 model: str = MODEL_NAME):
+                 model: str = MODEL_NAME,
+                 cache: Optional[LLMCache] = None,
+                 semantic_cache: Optional[SemanticCache] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 limiter: Optional[RateLimiter] = None):
         self.endpoint = endpoint
         self.api_key = api_key
         self.model = model
+        self.cache = cache if cache is not None else LLMCache(path=CACHE_PATH)
+        self.semantic_cache = semantic_cache
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limiter = limiter if limiter is not None else RateLimiter()
 
         if not self.api_key:
             raise ValueError("找不到 API KEY：請先設定環境變數 LEXIGUARD_API_KEY")
 
-    def _generate(self, prompt: str) -> str:
+        # 共用連線池（keep-alive），避免每次請求都重新做 TCP/TLS 握手
+        self._session = requests.Session()
+        self._session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+        })
+        # 連線池大小對齊併發數：預設只保留 10 條，MAX_CONCURRENCY 調大時多出的連線會被丟棄、下次重連；
+        # 重試由 _post 自己處理，adapter 不再重試
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(MAX_CONCURRENCY, 10), max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def _generate(self, prompt: str, system: Optional[str] = None) -> str:
         payload = {
             "model": self.model,
             "prompt": prompt,
             "stream": False,
         }
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}",
-        }
-        resp = requests.post(self.endpoint, headers=headers, json=payload, timeout=300)
-        resp.raise_for_status()
-        data = resp.json()
+        if system:
+            payload["system"] = system
+        resp = self._post(payload)
+        data = orjson.loads(resp.content)
         return (data.get("response") or "").strip()
 
+    def _generate_stream(self, prompt: str, system: Optional[str] = None) -> Iterator[str]:
+        """
+        以 "stream": true 呼叫 /api/generate，邊生成邊回傳文字片段。
+        Ollama 每行回一個 JSON 物件：{"response": "片段", "done": false}，最後一行 done 為 true。
+        重試只發生在收到回應標頭之前；開始輸出後中斷就直接丟出例外。
+        """
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": True,
+        }
+        if system:
+            payload["system"] = system
+        with self._post(payload, stream=True) as resp:
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                data = orjson.loads(line)
+                chunk = data.get("response")
+                if chunk:
+                    yield chunk
+                if data.get("done"):
+                    break
+
+    def _post(self, payload: Dict, stream: bool = False) -> requests.Response:
+        """
+        送出請求；每次嘗試（含重試）都先向 self.limiter 取得額度。
+        連線失敗、逾時與 429/5xx 視為暫時性錯誤，最多重試 MAX_RETRIES 次；
+        429 代表「放慢」，依 Retry-After 等待後重試，不回報給 self.breaker；
+        其餘暫時性錯誤在重試用盡後才算一次失敗。其他錯誤（例如 401）直接丟出。
+        熔斷中時新的請求直接丟出 CircuitOpenError，重試中的請求則等冷卻結束。
+        stream=True 時回應本文不會先讀完，由呼叫端逐行讀取並負責關閉。
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt == 0:
+                self.breaker.before_call()
+            else:
+                self.breaker.wait()
+            self.limiter.acquire()
+            resp = None
+            try:
+                resp = self._session.post(self.endpoint, data=orjson.dumps(payload), timeout=300, stream=stream)
+                resp.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+                transient = resp is None or resp.status_code in _RETRY_STATUS
+                if resp is not None:
+                    # stream=True 時連線不會自動歸還連線池，重試或丟出前先關閉
+                    resp.close()
+                if not transient:
+                    raise
+                if attempt == MAX_RETRIES:
+                    if resp is None or resp.status_code != 429:
+                        self.breaker.record_failure()
+                    raise
+                time.sleep(self._retry_delay(attempt, resp))
+                continue
+
+            self.breaker.record_success()
+            return resp
+
+    @staticmethod
+    def _retry_delay(attempt: int, resp: Optional[requests.Response]) -> float:
+        # 429 若有 Retry-After 就照上游要求放慢
+        if resp is not None and resp.status_code == 429:
+            retry_after = resp.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(RETRY_MAX_DELAY, float(retry_after))
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+        return delay + random.uniform(0, RETRY_BASE_DELAY)
+
+    def get_cached(self, clause_text: str) -> Optional[Dict]:
+        """回傳快取中的分析結果（不呼叫 LLM），沒有則為 None"""
+        return self._cache_get(self.cache.make_key(self.model, clause_text), clause_text)
+
+    def _cache_get(self, key: str, clause_text: str) -> Optional[Dict]:
+        cached = self.cache.get(key)
+        if cached is None and self.semantic_cache is not None:
+            cached = self.semantic_cache.get(clause_text)
+        return cached
+
+    def _cache_set(self, key: str, clause_text: str, parsed: Dict) -> None:
+        self.cache.set(key, parsed)
+        if self.semantic_cache is not None:
+            self.semantic_cache.set(key, clause_text, parsed)
+
     def analyze_clause(self, clause_text: str) -> Dict:
         """
         對「單一條款」呼叫 LLM，請它回傳一個 JSON：
@@ -71,44 +619,108 @@ class LLMClient:
           "risk_reason": "...",
           "suggestion": "..."
         }
-        """
 
-        system_instr = (
-            "你是一名協助一般民眾閱讀合約的法律顧問。\n"
-            "針對輸入的「單一合約條款」，請只輸出一個 JSON 物件，"
-            "欄位為：summary, risk_level, risk_type, risk_reason, suggestion。\n"
-            "限制：\n"
-            "1. risk_level 必須使用繁體中文：只能是「低」、「中」、「高」三者之一。\n"
-            "2. 其他欄位（summary, risk_type, risk_reason, suggestion）一律使用繁體中文，"
-            "不得包含英文句子或簡體字。\n"
-            "3. risk_type 請給出一個簡短的繁體中文分類，例如「自動續約風險」、「責任限制」、「資料隱私」等。\n"
-            "4. 不要輸出任何解說文字、說明、Markdown，只能輸出一個純 JSON 字串。\n"
-            "5. JSON 必須能被標準 JSON parser 解析（例如 Python json.loads），不要加註解、不要加反引號。\n"
-        )
+        相同 model 與條款原文的結果會從 self.cache 直接回傳；
+        有設定 semantic_cache 時，近似重複的條款也會沿用先前結果。
+        """
+        key = self.cache.make_key(self.model, clause_text)
+        cached = self._cache_get(key, clause_text)
+        if cached is not None:
+            return cached
 
         user_prompt = (
-            f"{system_instr}\n\n"
-            "請分析以下合約條款，依規格輸出 JSON：\n"
+            "請分析以下合約條款：\n"
             "----\n"
             f"{clause_text}\n"
             "----\n"
         )
 
-        content = self._generate(user_prompt)
+        content = self._generate(user_prompt, system=CLAUSE_SYSTEM_PROMPT)
 
         try:
-            parsed = json.loads(content)
-            for k in ["summary", "risk_level", "risk_type", "risk_reason", "suggestion"]:
-                parsed.setdefault(k, "")
+            parsed = _coerce_analysis(orjson.loads(content))
+        except orjson.JSONDecodeError:
+            parsed = None
+        if parsed is not None:
+            if normalize_risk_level(parsed["risk_level"]) in _VALID_RISK_LEVELS:
+                self._cache_set(key, clause_text, parsed)
+                return parsed
+            # 風險等級不是低／中／高：標為「未知」且不寫入快取，下次分析會重送
+            parsed["risk_reason"] = f"LLM 回傳的風險等級無效（{parsed['risk_level'] or '空白'}）；" + parsed["risk_reason"]
+            parsed["risk_level"] = "未知"
             return parsed
-        except json.JSONDecodeError:
-            return {
-                "summary": "",
-                "risk_level": "未知",
-                "risk_type": "",
-                "risk_reason": "LLM 回傳內容不是合法 JSON；原始輸出為：" + content[:200],
-                "suggestion": "",
-            }
+        return {
+            "summary": "",
+            "risk_level": "未知",
+            "risk_type": "",
+            "risk_reason": "LLM 回傳內容不是合法的 JSON 物件；原始輸出為：" + content[:200],
+            "suggestion": "",
+        }
+
+    def analyze_clauses_batch(self, clauses: List[str], fallback: bool = True) -> List[Optional[Dict]]:
+        """
+        把多個條款以 <clause id="n">…</clause> 打包成一次請求，請 LLM 回傳 JSON 陣列：
+
+        [{"id": 1, "summary": ..., "risk_level": ..., ...}, ...]
+
+        依 id 對回原本順序，合格的結果先全部寫入快取；整批解析失敗、缺漏，或單項欄位不合格
+        （不是物件、risk_level 不是低／中／高）的條款：
+        - fallback=True：改用 analyze_clause 逐條重送，某條重送失敗只影響該條（標為「未知」）
+        - fallback=False：該位置回傳 None，由呼叫端自行重送（analyze_document 會排進執行緒池並行）
+        已在快取中的條款不會送出。
+        """
+        keys = [self.cache.make_key(self.model, c) for c in clauses]
+        results: List[Optional[Dict]] = [self._cache_get(k, c) for k, c in zip(keys, clauses)]
+        pending = [i for i, r in enumerate(results) if r is None]
+
+        if len(pending) <= 1:
+            for i in pending:
+                results[i] = self._analyze_clause_guarded(clauses[i]) if fallback else self.analyze_clause(clauses[i])
+            return results
+
+        tagged = "\n".join(
+            f'<clause id="{n}">\n{clauses[i]}\n</clause>' for n, i in enumerate(pending, start=1)
+        )
+        user_prompt = f"請分析以下合約條款：\n{tagged}\n"
+
+        content = self._generate(user_prompt, system=BATCH_SYSTEM_PROMPT)
+
+        by_id: Dict[int, Dict] = {}
+        try:
+            parsed = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            parsed = None
+        if isinstance(parsed, list):
+            for item in parsed:
+                if not isinstance(item, dict):
+                    continue
+                item_id = _parse_item_id(item.get("id"))
+                if item_id is None:
+                    continue
+                checked = _coerce_analysis(item)
+                if normalize_risk_level(checked["risk_level"]) in _VALID_RISK_LEVELS:
+                    by_id[item_id] = checked
+
+        retry = []
+        for n, i in enumerate(pending, start=1):
+            item = by_id.get(n)
+            if item is None:
+                retry.append(i)
+                continue
+            self._cache_set(keys[i], clauses[i], item)
+            results[i] = item
+
+        if fallback:
+            for i in retry:
+                results[i] = self._analyze_clause_guarded(clauses[i])
+        return results
+
+    def _analyze_clause_guarded(self, clause_text: str) -> Dict:
+        """analyze_clause，但呼叫失敗時回傳「未知」結果而不丟出例外。"""
+        try:
+            return self.analyze_clause(clause_text)
+        except (requests.RequestException, CircuitOpenError, ValueError) as e:
+            return _failed_analysis(e)
 
     # A) 單一條款追問
     
@@ -124,21 +736,38 @@ class LLMClient:
         回傳「繁體中文」回答（非 JSON）。
         history: [{"q": "...", "a": "..."}, ...]
         """
-        question = (question or "").strip()
-        if not question:
+        prompt = self._followup_clause_prompt(clause_text, clause_analysis, question, history, max_history_turns)
+        if prompt is None:
             return "請先輸入你的問題。"
+        return self._generate(prompt, system=FOLLOWUP_CLAUSE_SYSTEM_PROMPT)
 
-        sys = (
-            "你是合約風險說明助理，面向一般民眾。\n"
-            "你只能根據我提供的『條款原文』與『系統分析結果』回答，不可憑空補條款。\n"
-            "一律使用繁體中文，不得出現英文句子或簡體字。\n"
-            "禁止使用『一定違法』『保證無效』等斷言，只能用『可能涉及』『可能有風險』。\n"
-            "回答要具體可操作：\n"
-            "- 若使用者問原因：請用「依本條…」引用條款內容說明。\n"
-            "- 若使用者問怎麼改：請提供可直接替換的條款示例文字（繁體中文）。\n"
-            "- 若資訊不足：請清楚指出缺少什麼資訊，並列出要補的資料。\n"
-            "請直接回答（不要 JSON、不要 Markdown）。\n"
-        )
+    def answer_followup_clause_stream(
+        self,
+        clause_text: str,
+        clause_analysis: Dict,
+        question: str,
+        history: Optional[List[Dict[str, str]]] = None,
+        max_history_turns: int = 6
+    ) -> Iterator[str]:
+        """同 answer_followup_clause，但邊生成邊回傳文字片段（可直接交給 st.write_stream）。"""
+        prompt = self._followup_clause_prompt(clause_text, clause_analysis, question, history, max_history_turns)
+        if prompt is None:
+            yield "請先輸入你的問題。"
+            return
+        yield from self._generate_stream(prompt, system=FOLLOWUP_CLAUSE_SYSTEM_PROMPT)
+
+    @staticmethod
+    def _followup_clause_prompt(
+        clause_text: str,
+        clause_analysis: Dict,
+        question: str,
+        history: Optional[List[Dict[str, str]]],
+        max_history_turns: int
+    ) -> Optional[str]:
+        """組單條追問的 prompt；問題是空的回傳 None。"""
+        question = (question or "").strip()
+        if not question:
+            return None
 
         analysis_block = (
             f"【系統分析結果】\n"
@@ -149,31 +778,18 @@ class LLMClient:
             f"- 建議：{clause_analysis.get('suggestion','')}\n"
         )
 
-        hist_txt = ""
-        if history:
-            history = history[-max_history_turns:]
-            turns = []
-            for t in history:
-                q = (t.get("q") or "").strip()
-                a = (t.get("a") or "").strip()
-                if q and a:
-                    turns.append(f"使用者問：{q}\n助理答：{a}")
-            if turns:
-                hist_txt = "【先前追問紀錄】\n" + "\n\n".join(turns) + "\n"
-
-        prompt = (
-            f"{sys}\n"
-            f"{hist_txt}"
+        hist_txt = _format_history(history, max_history_turns, "先前追問紀錄")
+
+        return (
             f"{analysis_block}\n"
             "【條款原文】\n"
             "----\n"
             f"{clause_text}\n"
             "----\n\n"
+            f"{hist_txt}"
             f"【使用者問題】{question}\n"
         )
 
-        return self._generate(prompt)
-
 
     # B) 整份合約追問聊天室
     
@@ -190,30 +806,40 @@ class LLMClient:
         top_risky: web端整理後的高風險摘要
         history: [{"q": "...", "a": "..."}, ...]
         """
-        question = (question or "").strip()
-        if not question:
+        prompt = self._followup_global_prompt(question, overall_summary, top_risky, history, max_history_turns)
+        if prompt is None:
             return "請先輸入你的問題。"
+        return self._generate(prompt, system=FOLLOWUP_GLOBAL_SYSTEM_PROMPT)
 
-        sys = (
-            "你是合約風險說明助理，面向一般民眾。\n"
-            "你只能依據我提供的『總結資訊』與『高風險條款摘要』回答，不可憑空補合約內容。\n"
-            "一律使用繁體中文，不得出現英文句子或簡體字。\n"
-            "禁止使用『一定違法』『保證無效』等斷言，只能用『可能涉及』『可能有風險』。\n"
-            "回答請以條列方式，並給出可執行的下一步（例如談判優先順序、要補齊的資訊）。\n"
-            "請直接回答（不要 JSON、不要 Markdown）。\n"
-        )
+    def answer_followup_global_stream(
+        self,
+        question: str,
+        overall_summary: Dict,
+        top_risky: List[Dict],
+        history: Optional[List[Dict[str, str]]] = None,
+        max_history_turns: int = 8
+    ) -> Iterator[str]:
+        """同 answer_followup_global，但邊生成邊回傳文字片段（可直接交給 st.write_stream）。"""
+        prompt = self._followup_global_prompt(question, overall_summary, top_risky, history, max_history_turns)
+        if prompt is None:
+            yield "請先輸入你的問題。"
+            return
+        yield from self._generate_stream(prompt, system=FOLLOWUP_GLOBAL_SYSTEM_PROMPT)
+
+    @staticmethod
+    def _followup_global_prompt(
+        question: str,
+        overall_summary: Dict,
+        top_risky: List[Dict],
+        history: Optional[List[Dict[str, str]]],
+        max_history_turns: int
+    ) -> Optional[str]:
+        """組整份合約追問的 prompt；問題是空的回傳 None。"""
+        question = (question or "").strip()
+        if not question:
+            return None
 
-        hist_txt = ""
-        if history:
-            history = history[-max_history_turns:]
-            turns = []
-            for t in history:
-                q = (t.get("q") or "").strip()
-                a = (t.get("a") or "").strip()
-                if q and a:
-                    turns.append(f"使用者問：{q}\n助理答：{a}")
-            if turns:
-                hist_txt = "【聊天室紀錄】\n" + "\n\n".join(turns) + "\n"
+        hist_txt = _format_history(history, max_history_turns, "聊天室紀錄")
 
         summary_txt = (
             "【整體總結】\n"
@@ -235,97 +861,227 @@ class LLMClient:
             )
         risky_txt = "\n".join(risky_lines)
 
-        prompt = (
-            f"{sys}\n"
-            f"{hist_txt}"
+        return (
             f"{summary_txt}\n\n"
             f"{risky_txt}\n\n"
+            f"{hist_txt}"
             f"【使用者問題】{question}\n"
         )
 
-        return self._generate(prompt)
 
+# PDF 文字抽取
 
-# 條款切分相關
+# pdfplumber 的 extract_text 只看字元座標，不需要 pdfminer 的版面分析：
+# open() 時不傳 laparams（傳了反而多跑一次 layout analysis，實測慢約兩成，抽出的文字相同）；
+# 容差明確寫出（即 pdfplumber 預設值），調整時只改這裡
+_PDFPLUMBER_TEXT_KWARGS = {"x_tolerance": 3, "y_tolerance": 3}
 
-def is_trivial_clause(text: str) -> bool:
+
+def _open_pdfplumber(data: bytes):
+    return pdfplumber.open(io.BytesIO(data), laparams=None)
+
+
+def _pdfplumber_page_text(page) -> str:
+    text = page.extract_text(**_PDFPLUMBER_TEXT_KWARGS) or ""
+    # 釋放該頁的版面解析快取，避免大型 PDF 所有頁面同時留在記憶體
+    page.flush_cache()
+    return text
+
+
+def _extract_pdf_range(data: bytes, start: int, stop: int) -> str:
+    """以 pdfplumber 抽取第 start ~ stop-1 頁的文字，頁與頁之間以換行相接。"""
+    out = io.StringIO()
+    with _open_pdfplumber(data) as pdf:
+        for n, page in enumerate(pdf.pages[start:stop]):
+            if n:
+                out.write("\n")
+            out.write(_pdfplumber_page_text(page))
+    return out.getvalue()
+
+
+def _map_pdf_ranges(extract_range, data: bytes, n_pages: int, workers: int) -> Iterator[str]:
     """
-    判斷這段是不是沒什麼內容的條款，可以略過不送給LLM
+    把 n_pages 頁切成 workers 段連續頁段交給多個行程，每個行程自行開啟 PDF，
+    依頁序逐段 yield extract_range(data, start, stop) 的結果。
     """
-    s = (text or "").strip()
-    if not s:
-        return True
-    if s == "---":
-        return True
+    step = -(-n_pages // workers)
+    starts = range(0, n_pages, step)
+    with ProcessPoolExecutor(max_workers=len(starts)) as pool:
+        yield from pool.map(extract_range,
+                            [data] * len(starts),
+                            starts,
+                            [s + step for s in starts])
 
-    lines = [ln.strip() for ln in s.splitlines() if ln.strip()]
-    if not lines:
-        return True
 
+def _iter_pages_pdfplumber(data: bytes) -> Iterator[str]:
+    # 頁數達 PDF_PARALLEL_MIN_PAGES 時改以多個行程逐段抽取
+    with _open_pdfplumber(data) as pdf:
+        n_pages = len(pdf.pages)
 
-    han = len(re.findall(r"[\u4e00-\u9fff]", s))
-    if han < 4 and len(s) < 20:
-        return True
+    workers = min(PDF_MAX_WORKERS, os.cpu_count() or 1)
+    if n_pages < PDF_PARALLEL_MIN_PAGES or workers < 2:
+        with _open_pdfplumber(data) as pdf:
+            for page in pdf.pages:
+                yield _pdfplumber_page_text(page)
+        return
 
-    return False
+    yield from _map_pdf_ranges(_extract_pdf_range, data, n_pages, workers)
 
 
-def detect_style(text: str):
-    has_article = bool(re.search(r'第\s*[一二三四五六七八九十0-9]+\s*條', text))
-    has_chinese_num = bool(re.search(r'^[一二三四五六七八九十]+\s*[、．.]', text, re.M))
-    return has_article, has_chinese_num
+def _pymupdf_page_text(page) -> str:
+    # PyMuPDF 會保留行尾空白與空白行，整理成與 pdfplumber 相同的形式，免得浪費 LLM token
+    return "\n".join(ln.rstrip() for ln in page.get_text("text").splitlines() if ln.strip())
 
 
-def is_clause_start(line: str, has_article: bool, has_chinese_num: bool) -> bool:
-    s = (line or "").strip()
-    if not s:
-        return False
+def _extract_pdf_range_pymupdf(data: bytes, start: int, stop: int) -> str:
+    """以 PyMuPDF 抽取第 start ~ stop-1 頁的文字，頁與頁之間以換行相接。"""
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        return "\n".join(_pymupdf_page_text(doc[n]) for n in range(start, min(stop, doc.page_count)))
+
+
+def _iter_pages_pymupdf(data: bytes) -> Iterator[str]:
+    # 頁數達 PDF_PYMUPDF_PARALLEL_MIN_PAGES 時改以多個行程逐段抽取
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        n_pages = doc.page_count
+        workers = min(PDF_MAX_WORKERS, os.cpu_count() or 1)
+        if n_pages < PDF_PYMUPDF_PARALLEL_MIN_PAGES or workers < 2:
+            for page in doc:
+                yield _pymupdf_page_text(page)
+            return
+
+    yield from _map_pdf_ranges(_extract_pdf_range_pymupdf, data, n_pages, workers)
+
+
+def iter_pdf_pages(data: bytes, backend: str = PDF_BACKEND) -> Iterator[str]:
+    """
+    依頁序逐頁 yield PDF 文字（pdfplumber 多行程模式下為逐段頁）。
+    backend: "pymupdf"（預設）或 "pdfplumber"
+    """
+    if backend == "pymupdf":
+        return _iter_pages_pymupdf(data)
+    if backend == "pdfplumber":
+        return _iter_pages_pdfplumber(data)
+    raise ValueError(f"不支援的 PDF 後端：{backend}（可用 pymupdf / pdfplumber）")
+
+
+def extract_pdf_text(data: bytes, backend: str = PDF_BACKEND) -> str:
+    """從 PDF bytes 抽出全文（各頁以換行相接）"""
+    return "\n".join(iter_pdf_pages(data, backend))
+
+
+# 條款切分相關
+
+def _count_han(s: str) -> int:
+    # 刪掉非漢字後取長度：整段在 C 層完成，不會替每個字建立 list 元素
+    return len(_RE_NON_HAN.sub("", s))
+
 
-    if has_article and re.match(r'^第\s*[一二三四五六七八九十0-9]+\s*條', s):
+def _is_trivial_stripped(s: str) -> bool:
+    # s 已 strip 且非空；長度 >= 20 的條款不必再數漢字
+    if s == "---":
         return True
+    return len(s) < 20 and _count_han(s) < 4
+
 
-    if has_chinese_num and re.match(r'^[一二三四五六七八九十]+\s*[、．.]', s):
+def is_trivial_clause(text: str) -> bool:
+    """
+    判斷這段是不是沒什麼內容的條款，可以略過不送給LLM
+    """
+    s = (text or "").strip()
+    if not s:
         return True
+    return _is_trivial_stripped(s)
+
 
+def detect_style(text: str):
+    has_article = bool(_RE_ARTICLE.search(text))
+    has_chinese_num = bool(_RE_CHINESE_NUM.search(text))
+    return has_article, has_chinese_num
+
+
+def _compile_clause_start(has_article: bool, has_chinese_num: bool) -> "re.Pattern":
+    # 依文件風格把可用的條款開頭規則合併成單一 regex，每行只需 match 一次；
+    # 開頭的 \s* 取代 strip()，不必為每行建立新字串
+    alts = []
+    if has_article:
+        alts.append(_RE_ARTICLE.pattern)
+    if has_chinese_num:
+        alts.append(r'[一二三四五六七八九十]+\s*[、．.]')
     if not has_article and not has_chinese_num:
-        if re.match(r'^\d+\s*[\.．]', s):
-            return True
-        if re.match(r'^[（(]?\s*[一二三四五六七八九十0-9]+\s*[)）]', s):
-            return True
+        alts.append(_RE_ARABIC_NUM.pattern)
+        alts.append(_RE_PAREN_NUM.pattern)
+    return re.compile(r'\s*(?:' + '|'.join(alts) + ')')
 
-    return False
 
+_RE_CLAUSE_START = {
+    (a, c): _compile_clause_start(a, c) for a in (False, True) for c in (False, True)
+}
 
-def segment_clauses(text: str) -> List[str]:
-    normalized = re.sub(r'\r\n', '\n', text or "")
-    has_article, has_chinese_num = detect_style(normalized)
-    lines = normalized.split('\n')
 
-    clauses: List[str] = []
-    buf: List[str] = []
+def is_clause_start(line: str, has_article: bool, has_chinese_num: bool) -> bool:
+    return _RE_CLAUSE_START[(has_article, has_chinese_num)].match(line or "") is not None
 
+
+def _iter_raw_segments(lines: Iterable[str], match_start) -> Iterator[str]:
+    """依條款開頭切段，逐段 yield strip 後非空的文字（尚未過濾空洞條款與抬頭）"""
+    buf = io.StringIO()
+    started = False
     for line in lines:
-        if is_clause_start(line, has_article, has_chinese_num) and buf:
-            clause_text = "\n".join(buf).strip()
-            if clause_text:
-                clauses.append(clause_text)
-            buf = [line]
-        else:
-            buf.append(line)
+        if started and match_start(line):
+            text = buf.getvalue().strip()
+            if text:
+                yield text
+            buf = io.StringIO()
+        buf.write(line)
+        buf.write("\n")
+        started = True
+    text = buf.getvalue().strip()
+    if text:
+        yield text
+
+
+def segment_pages(pages: Iterable[str]) -> Iterator[str]:
+    """
+    逐頁讀入文字（例如 iter_pdf_pages 的輸出），切分後逐條 yield 有效條款。
 
-    last = "\n".join(buf).strip()
-    if last:
-        clauses.append(last)
+    注意這不是串流切分：條款開頭規則取決於全文風格（detect_style），要讀完最後一頁才能確定，
+    所以會先讀完所有頁面、保留逐行字串，才開始切分；好處只是不必另外組出整份全文。
+    """
+    lines: List[str] = []
+    has_article = has_chinese_num = False
+    for page in pages:
+        page = page or ""
+        a, c = detect_style(page)
+        has_article, has_chinese_num = has_article or a, has_chinese_num or c
+        # splitlines 直接處理 \r\n，不必先複製一份正規化後的全文
+        lines.extend(page.splitlines())
+
+    match_start = _RE_CLAUSE_START[(has_article, has_chinese_num)].match
+
+    # 切分時就順便判斷是否為空洞條款，不再對結果做第二輪掃描；
+    # 抬頭判斷以「第一段」為準（不論它是否空洞），要等到第二段出現才知道是否丟掉它。
+    first = None
+    first_kept = False
+    n_raw = 0
+    for clause_text in _iter_raw_segments(lines, match_start):
+        n_raw += 1
+        kept = not _is_trivial_stripped(clause_text)
+        if n_raw == 1:
+            first, first_kept = clause_text, kept
+            continue
+        if n_raw == 2 and first_kept:
+            # 丟掉最前面的抬頭（如果沒有「第 X 條」或「一、」等字樣）
+            if _RE_ARTICLE.search(first) or _RE_CHINESE_NUM.search(first):
+                yield first
+        if kept:
+            yield clause_text
+
+    if n_raw == 1 and first_kept:
+        yield first
 
-    # 丟掉最前面的抬頭（如果沒有「第 X 條」或「一、」等字樣）
-    if len(clauses) >= 2:
-        first = clauses[0]
-        if not re.search(r'第\s*[一二三四五六七八九十0-9]+\s*條', first) and \
-           not re.search(r'^[一二三四五六七八九十]+\s*[、．.]', first, re.M):
-            clauses = clauses[1:]
 
-    clauses = [c for c in clauses if not is_trivial_clause(c)]
-    return clauses
+def segment_clauses(text: str) -> List[str]:
+    return list(segment_pages([text or ""]))
 
 
 # 風險等級與報告
@@ -344,54 +1100,137 @@ def normalize_risk_level(lv: str) -> str:
     return mapping.get(s, s if s else "未知")
 
 
+def _failed_analysis(err: Exception) -> Dict:
+    return {
+        "summary": "",
+        "risk_level": "未知",
+        "risk_type": "",
+        "risk_reason": f"LLM 呼叫失敗：{err}",
+        "suggestion": "",
+    }
+
+
 def analyze_document(clauses: List[str],
                      llm: LLMClient,
-                     progress_callback=None) -> List[Dict]:
-    results: List[Dict] = []
+                     progress_callback=None,
+                     max_concurrency: int = MAX_CONCURRENCY,
+                     batch_size: int = BATCH_SIZE) -> List[Dict]:
+    """
+    已有快取的條款直接沿用；其餘每 batch_size 條打包成一次請求，各批次並行送出，
+    回傳結果順序與 clauses 相同。
+    呼叫失敗的批次不會中斷分析，該批條款的 risk_level 為「未知」並在 risk_reason 註明原因。
+    progress_callback(done, total) 於每完成一批時呼叫（在呼叫端執行緒），done 以條款數計。
+    """
     total = len(clauses)
+    results: List[Optional[Dict]] = [None] * total
+    if total == 0:
+        return []
 
-    for i, c in enumerate(clauses, start=1):
-        if progress_callback is not None:
-            progress_callback(i, total)
-
-        analysis = llm.analyze_clause(c)
-        lv_norm = normalize_risk_level(analysis.get("risk_level", ""))
-
-        results.append({
-            "clause": c,
+    def store(i: int, analysis: Dict) -> None:
+        results[i] = {
+            "clause": clauses[i],
             "summary": analysis.get("summary", ""),
-            "risk_level": lv_norm,
+            "risk_level": normalize_risk_level(analysis.get("risk_level", "")),
             "risk_type": analysis.get("risk_type", ""),
             "risk_reason": analysis.get("risk_reason", ""),
             "suggestion": analysis.get("suggestion", ""),
-        })
+        }
+
+    # 快取命中的條款直接填入並一次回報進度，只把其餘條款分批送出
+    pending: List[int] = []
+    for i, c in enumerate(clauses):
+        cached = llm.get_cached(c)
+        if cached is None:
+            pending.append(i)
+        else:
+            store(i, cached)
+
+    done = total - len(pending)
+    if done and progress_callback is not None:
+        progress_callback(done, total)
+    if not pending:
+        return results
+
+    batch_size = max(1, batch_size)
+    batches = [pending[s:s + batch_size] for s in range(0, len(pending), batch_size)]
+
+    workers = max(1, min(max_concurrency, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # future -> (條款 index 清單, 是否為單條重送)
+        futures = {
+            pool.submit(llm.analyze_clauses_batch, [clauses[i] for i in idxs], False): (idxs, False)
+            for idxs in batches
+        }
+
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            n_done = 0
+            for fut in finished:
+                idxs, single = futures.pop(fut)
+                try:
+                    analyses = [fut.result()] if single else fut.result()
+                except (requests.RequestException, CircuitOpenError, ValueError) as e:
+                    # 單一批次失敗不中斷整份分析，保留其他條款的結果；
+                    # ValueError 涵蓋上游回 200 但本文不是 JSON（例如閘道的 HTML 錯誤頁）
+                    analyses = [_failed_analysis(e)] * len(idxs)
+
+                for i, analysis in zip(idxs, analyses):
+                    if analysis is None:
+                        # 批次中缺漏或不合格的條款改逐條重送，與其他批次一起排進執行緒池
+                        futures[pool.submit(llm.analyze_clause, clauses[i])] = ([i], True)
+                        continue
+                    store(i, analysis)
+                    n_done += 1
+
+            done += n_done
+            if n_done and progress_callback is not None:
+                progress_callback(done, total)
 
     return results
 
 
-def compute_overall_risk_score(results: List[Dict]) -> int:
-    score_map = {"低": 1, "中": 3, "高": 5}
+def count_risk_levels(results: List[Dict]) -> Counter:
+    """一次走訪統計各風險等級的條款數，例如 counts["高"]。"""
+    return Counter(normalize_risk_level(r.get("risk_level", "")) for r in results)
 
-    scores = []
-    for r in results:
-        lvl = normalize_risk_level(r.get("risk_level", ""))
-        if lvl in score_map:
-            scores.append(score_map[lvl])
 
-    if not scores:
+def compute_overall_risk_score(results: List[Dict], counts: Optional[Counter] = None) -> int:
+    """
+    依各等級條款數算出 0~100 的整體風險分數；
+    已有 count_risk_levels 的結果時可傳入 counts，省去再掃一次 results。
+    """
+    score_map = {"低": 1, "中": 3, "高": 5}
+    if counts is None:
+        counts = count_risk_levels(results)
+
+    n = sum(counts[lvl] for lvl in score_map)
+    if not n:
         return 0
 
-    avg = sum(scores) / len(scores)  # 1~5
+    avg = sum(score * counts[lvl] for lvl, score in score_map.items()) / n  # 1~5
     normalized = int((avg - 1) / (5 - 1) * 100)  # 0~100
     return max(0, min(100, normalized))
 
 
-def create_markdown_report(results: List[Dict]) -> str:
-    overall_score = compute_overall_risk_score(results)
+_CLAUSE_TMPL = (
+    "## 第 {i} 條\n\n"
+    "**原文：**\n"
+    "```text\n"
+    "{clause}\n"
+    "```\n\n"
+    "- **摘要**：{summary}\n"
+    "- **風險等級**：{risk_level}\n"
+    "- **風險類型**：{risk_type}\n"
+    "- **風險原因**：{risk_reason}\n"
+    "- **建議**：{suggestion}\n"
+    "\n---\n"
+)
 
-    high_count = sum(1 for r in results if normalize_risk_level(r.get("risk_level", "")) == "高")
-    med_count  = sum(1 for r in results if normalize_risk_level(r.get("risk_level", "")) == "中")
-    low_count  = sum(1 for r in results if normalize_risk_level(r.get("risk_level", "")) == "低")
+
+def create_markdown_report(results: List[Dict]) -> str:
+    counts = count_risk_levels(results)
+    overall_score = compute_overall_risk_score(results, counts)
+    high_count, med_count, low_count = counts["高"], counts["中"], counts["低"]
 
     lines: List[str] = []
     lines.append("# 合約風險分析報告\n")
@@ -402,19 +1241,9 @@ def create_markdown_report(results: List[Dict]) -> str:
     lines.append(f"- 低風險條款數量：**{low_count}**")
     lines.append("\n---\n")
 
+    # risk_level 已在 analyze_document 正規化，這裡直接套用
     for i, r in enumerate(results, start=1):
-        lines.append(f"## 第 {i} 條\n")
-        lines.append("**原文：**")
-        lines.append("```text")
-        lines.append(r["clause"])
-        lines.append("```\n")
-
-        lines.append(f"- **摘要**：{r['summary']}")
-        lines.append(f"- **風險等級**：{normalize_risk_level(r['risk_level'])}")
-        lines.append(f"- **風險類型**：{r['risk_type']}")
-        lines.append(f"- **風險原因**：{r['risk_reason']}")
-        lines.append(f"- **建議**：{r['suggestion']}")
-        lines.append("\n---\n")
+        lines.append(_CLAUSE_TMPL.format_map(dict(r, i=i)))
 
     return "\n".join(lines)
 
@@ -1,35 +1,106 @@
 # -*- coding: utf-8 -*-
 
-import pdfplumber
+import codecs
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List
+
 import streamlit as st
+from charset_normalizer import from_bytes
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 from lexiguard_core import (
+    ChatStore,
     LLMClient,
-    segment_clauses,
+    iter_pdf_pages,
+    segment_pages,
     analyze_document,
     compute_overall_risk_score,
     create_markdown_report,
-    normalize_risk_level,
+    find_repeated_answer,
 )
 
-def load_text_from_upload(uploaded_file) -> str:
-    if uploaded_file is None:
-        return ""
-    filename = uploaded_file.name.lower()
+def decode_text(data: bytes) -> str:
+    """
+    解碼上傳的 .txt：有 BOM 就照 BOM；否則先試 UTF-8（最常見，最快），
+    不是合法 UTF-8 時（例如存成 Big5／GBK 的中文合約）交給 charset_normalizer 判斷編碼，
+    都判斷不出來才以 UTF-8 解碼並把壞掉的位元組換成 U+FFFD，不會默默丟掉內容。
+    """
+    if data.startswith(codecs.BOM_UTF8):
+        return data[len(codecs.BOM_UTF8):].decode("utf-8", errors="replace")
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return data.decode("utf-16", errors="replace")
+
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+
+    best = from_bytes(data).best()
+    if best is not None:
+        return str(best)
+    return data.decode("utf-8", errors="replace")
+
+
+def iter_pages(file_bytes: bytes, filename: str) -> Iterator[str]:
+    """
+    逐頁產生上傳檔案的文字（.txt 視為單一頁），直接交給 segment_pages，
+    不必先把所有頁面接成一整段全文。
+    """
+    filename = filename.lower()
 
     if filename.endswith(".txt"):
-        return uploaded_file.getvalue().decode("utf-8", errors="ignore")
+        return iter((decode_text(file_bytes),))
 
     if filename.endswith(".pdf"):
-        pages = []
-        with pdfplumber.open(uploaded_file) as pdf:
-            for page in pdf.pages:
-                pages.append(page.extract_text() or "")
-        return "\n".join(pages)
+        return iter_pdf_pages(file_bytes)
 
     raise ValueError("目前只支援 .txt 或 .pdf")
 
 
+@st.cache_data(show_spinner=False, max_entries=32)
+def parse_and_segment(file_bytes: bytes, filename: str) -> List[str]:
+    """
+    解析上傳檔並切分條款；以檔案內容為快取 key，重新上傳同一份檔案不必再解析 PDF。
+    快取最多保留 32 份檔案，超過時淘汰最久未使用的，避免長時間執行的伺服器記憶體無限成長
+    """
+    return list(segment_pages(iter_pages(file_bytes, filename)))
+
+
+@st.cache_resource
+def get_llm() -> LLMClient:
+    """
+    整個 Streamlit 行程共用同一個 LLMClient（連線池與條款快取跨 rerun 保留）
+    """
+    return LLMClient()
+
+
+REUSED_NOTE = "（與先前問題相同，沿用之前的回答）"
+
+
+@st.cache_resource
+def get_chat_store() -> ChatStore:
+    """追問紀錄存檔，與分析快取共用同一個 SQLite 檔"""
+    return ChatStore()
+
+
+def get_owner_id() -> str:
+    """
+    追問紀錄的擁有者 id，放在網址的 ?sid= 參數：重新整理頁面後沿用同一份紀錄，
+    其他人上傳同一份合約時 id 不同，看不到彼此的問答（把含 sid 的網址分享出去則會共用）。
+    """
+    sid = st.query_params.get("sid")
+    if not sid:
+        sid = uuid.uuid4().hex
+        st.query_params["sid"] = sid
+    return sid
+
+
+def save_chat(scope: str, turns: List[Dict]):
+    get_chat_store().save(st.session_state["contract_key"], scope, turns)
+
+
 def get_clause_title(clause_text: str) -> str:
     """
     抓條款第一行當標題（過長就截斷）
@@ -40,6 +111,146 @@ def get_clause_title(clause_text: str) -> str:
     return first or "（未命名條款）"
 
 
+def summarize_results(results: List[Dict]) -> Dict:
+    """
+    分析完成後整理一次並存進 session_state，之後每次 rerun 直接讀取：
+    - 每條結果補上 _title（標題）與 _excerpt（120 字摘錄）
+    - overall_summary：條款數、整體分數與各等級數量
+    - top_risky：最多 5 條高風險條款摘要（給聊天室用）
+    - report_md：下載用的 Markdown 報告
+    """
+    # 一次走訪同時補欄位、計數並收集高風險條款；
+    # analyze_document 已把 risk_level 正規化成「高／中／低／未知」，以下直接使用，不再逐次正規化
+    counts: Counter = Counter()
+    top_risky = []
+    for idx, r in enumerate(results, start=1):
+        r["_title"] = get_clause_title(r["clause"])
+        excerpt = r["clause"].replace("\n", " ")
+        r["_excerpt"] = excerpt[:120] + "..." if len(excerpt) > 120 else excerpt
+
+        lvl = r["risk_level"]
+        counts[lvl] += 1
+        if lvl == "高" and len(top_risky) < 5:
+            top_risky.append({
+                "idx": idx,
+                "title": r["_title"],
+                "risk_level": lvl,
+                "risk_type": r.get("risk_type", ""),
+                "risk_reason": r.get("risk_reason", ""),
+                "suggestion": r.get("suggestion", ""),
+                "clause_excerpt": r["_excerpt"],
+            })
+
+    overall_summary = {
+        "total": len(results),
+        "score": compute_overall_risk_score(results, counts),
+        "high": counts["高"],
+        "mid": counts["中"],
+        "low": counts["低"],
+    }
+
+    return {
+        "overall_summary": overall_summary,
+        "top_risky": top_risky,
+        "report_md": create_markdown_report(results),
+    }
+
+
+@st.fragment
+def render_clause(i: int, r: Dict):
+    """
+    單一條款的分析內容與追問區。包成 fragment，在這裡輸入或送出追問時
+    只重跑這一條，不會重畫整頁的所有條款。
+    """
+    # 原文是最重的元素（整段條款送進 st.code），勾選後才畫；
+    # 沒勾的條款每次 rerun 只剩幾行 markdown
+    if st.checkbox("顯示原文", key=f"clause_show_{i}"):
+        st.markdown("**原文：**")
+        st.code(r["clause"], language="text")
+    st.markdown(f"**摘要：** {r['summary']}")
+    st.markdown(f"**風險等級：** {r['risk_level']}")
+    st.markdown(f"**風險類型：** {r['risk_type']}")
+    st.markdown(f"**風險原因：** {r['risk_reason']}")
+    st.markdown(f"**建議：** {r['suggestion']}")
+
+    #  A) 單條追問
+    st.markdown("### 針對本條追問")
+    q_key = f"clause_q_{i}"
+    ask_key = f"clause_ask_{i}"
+
+    user_q = st.text_area("輸入你的問題（例如：我該怎麼改這條？）", key=q_key, height=80)
+
+    colA, colB = st.columns([1, 5])
+    with colA:
+        do_ask = st.button("送出追問", key=ask_key)
+
+    if do_ask:
+        history = st.session_state["clause_qa"].get(i, [])
+        # 同一條問過相同的問題就直接沿用先前的回答（紀錄中會標示）
+        ans = find_repeated_answer(user_q, history)
+        reused = ans is not None
+        if not reused:
+            # 邊生成邊顯示；完成後清掉，改由下方的追問紀錄顯示
+            placeholder = st.empty()
+            with placeholder:
+                ans = st.write_stream(get_llm().answer_followup_clause_stream(
+                    clause_text=r["clause"],
+                    clause_analysis=r,
+                    question=user_q,
+                    history=history
+                ))
+            placeholder.empty()
+        history.append({"q": user_q, "a": ans.strip(), "reused": reused})
+        st.session_state["clause_qa"][i] = history
+        save_chat(f"clause:{i}", history)
+
+    # 顯示追問紀錄
+    history = st.session_state["clause_qa"].get(i, [])
+    if history:
+        st.markdown("#### 追問紀錄")
+        for t in history[-6:]:
+            note = REUSED_NOTE if t.get("reused") else ""
+            st.markdown(f"- **問：** {t['q']}\n\n  **答：**{note} {t['a']}")
+
+
+@st.fragment
+def render_global_chat(overall_summary: Dict, top_risky: List[Dict]):
+    """整份合約的聊天室；同樣是 fragment，送出問題時只重跑聊天室。"""
+    # 顯示聊天紀錄
+    for item in st.session_state["global_chat"][-10:]:
+        with st.chat_message("user"):
+            st.write(item["q"])
+        with st.chat_message("assistant"):
+            if item.get("reused"):
+                st.caption(REUSED_NOTE)
+            st.write(item["a"])
+
+    user_global_q = st.chat_input("輸入你對整份合約的問題（例如：我該優先改哪三條？）")
+
+    if user_global_q:
+        history = st.session_state["global_chat"]
+
+        with st.chat_message("user"):
+            st.write(user_global_q)
+        with st.chat_message("assistant"):
+            ans = find_repeated_answer(user_global_q, history)
+            reused = ans is not None
+            if not reused:
+                ans = st.write_stream(get_llm().answer_followup_global_stream(
+                    question=user_global_q,
+                    overall_summary=overall_summary,
+                    top_risky=top_risky,
+                    history=history
+                ))
+            else:
+                st.caption(REUSED_NOTE)
+                st.write(ans)
+
+        history.append({"q": user_global_q, "a": ans.strip(), "reused": reused})
+        st.session_state["global_chat"] = history
+        save_chat("global", history)
+
+
 def main():
     st.set_page_config(page_title="LexiGuard 合約風險分析器", layout="wide")
     st.title("LexiGuard：AI 合約風險分析器")
@@ -49,11 +260,15 @@ def main():
         st.session_state["results"] = None
     if "clauses" not in st.session_state:
         st.session_state["clauses"] = None
+    if "summary" not in st.session_state:
+        st.session_state["summary"] = None
     if "clause_qa" not in st.session_state:
         # clause_qa[i] = [{"q":..., "a":...}, ...]
         st.session_state["clause_qa"] = {}
     if "global_chat" not in st.session_state:
         st.session_state["global_chat"] = []  # [{"q":..., "a":...}...]
+    if "contract_key" not in st.session_state:
+        st.session_state["contract_key"] = None  # 合約內容的 sha256，追問紀錄依此存檔
 
     uploaded_file = st.file_uploader("上傳合約檔案（支援 .txt / .pdf）", type=["txt", "pdf"])
 
@@ -64,12 +279,25 @@ def main():
     st.success(f"已上傳：{uploaded_file.name}")
 
     if st.button("開始分析"):
-        try:
-            text = load_text_from_upload(uploaded_file)
-            clauses = segment_clauses(text)
-        except Exception as e:
-            st.error(f"讀取/切分失敗：{e}")
-            return
+        # 解析／切分放到背景執行緒，同時在主執行緒初始化 LLMClient，兩者重疊進行；
+        # 等待解析時顯示 spinner，不會整段畫面沒有反應
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(max_workers=1, initializer=lambda: add_script_run_ctx(ctx=ctx)) as ex:
+            file_bytes = uploaded_file.getvalue()
+            parse_future = ex.submit(parse_and_segment, file_bytes, uploaded_file.name)
+
+            llm_error = None
+            try:
+                get_llm()
+            except Exception as e:
+                llm_error = e
+
+            with st.spinner("解析檔案中..."):
+                try:
+                    clauses = parse_future.result()
+                except Exception as e:
+                    st.error(f"讀取/切分失敗：{e}")
+                    return
 
         if not clauses:
             st.warning("無法切出任何有效條款。")
@@ -77,24 +305,32 @@ def main():
 
         st.session_state["clauses"] = clauses
         st.session_state["results"] = None
-        st.session_state["clause_qa"] = {}
-        st.session_state["global_chat"] = []
+        st.session_state["summary"] = None
+
+        # 同一位使用者對同一份合約先前的追問紀錄（重新整理頁面或重啟後）直接接續
+        contract_key = ChatStore.make_key(get_owner_id(), file_bytes)
+        saved = get_chat_store().load_all(contract_key)
+        st.session_state["contract_key"] = contract_key
+        st.session_state["clause_qa"] = {
+            int(scope.split(":", 1)[1]): turns
+            for scope, turns in saved.items() if scope.startswith("clause:")
+        }
+        st.session_state["global_chat"] = saved.get("global", [])
 
         st.info(f"偵測到 {len(clauses)} 段有效條款，開始分析...")
 
-        try:
-            llm = LLMClient()
-        except Exception as e:
-            st.error(str(e))
+        if llm_error is not None:
+            st.error(str(llm_error))
             return
 
         progress = st.progress(0.0, text="分析中...")
 
         def progress_cb(i, total):
-            progress.progress(i / total, text=f"分析第 {i}/{total} 條...")
+            progress.progress(i / total, text=f"已完成 {i}/{total} 條...")
 
         try:
-            results = analyze_document(clauses, llm, progress_callback=progress_cb)
+            # 同一份合約再分析時，各條款由 LLMClient 的快取（記憶體＋SQLite）直接命中，不會重送 LLM
+            results = analyze_document(clauses, get_llm(), progress_callback=progress_cb)
         except Exception as e:
             st.error(f"分析過程發生錯誤：{e}")
             return
@@ -102,83 +338,49 @@ def main():
             progress.empty()
 
         st.session_state["results"] = results
-        st.success("分析完成！")
+        st.session_state["summary"] = summarize_results(results)
+        failed = sum(1 for r in results if r["risk_level"] == "未知")
+        if failed:
+            # 失敗的條款不會寫入 LLMClient 快取，下次按「開始分析」只重送這些條款
+            st.warning(f"分析完成，但有 {failed} 條未能取得有效結果（風險等級標示為「未知」），其餘結果仍可參考。")
+        else:
+            st.success("分析完成！")
 
     # 如果已分析，就顯示結果
     results = st.session_state.get("results")
     clauses = st.session_state.get("clauses")
+    summary = st.session_state.get("summary")
 
-    if not results or not clauses:
+    if not results or not clauses or not summary:
         st.info("按下『開始分析』後會顯示結果。")
         return
 
-    overall_score = compute_overall_risk_score(results)
-    high_count = sum(1 for r in results if normalize_risk_level(r["risk_level"]) == "高")
-    med_count  = sum(1 for r in results if normalize_risk_level(r["risk_level"]) == "中")
-    low_count  = sum(1 for r in results if normalize_risk_level(r["risk_level"]) == "低")
+    overall_summary = summary["overall_summary"]
+    top_risky = summary["top_risky"]
 
     st.subheader("分析總結")
     c1, c2, c3, c4 = st.columns(4)
-    c1.metric("條款總數", len(results))
-    c2.metric("高風險", high_count)
-    c3.metric("中風險", med_count)
-    c4.metric("低風險", low_count)
-    st.markdown(f"**整體風險分數：** `{overall_score} / 100`")
+    c1.metric("條款總數", overall_summary["total"])
+    c2.metric("高風險", overall_summary["high"])
+    c3.metric("中風險", overall_summary["mid"])
+    c4.metric("低風險", overall_summary["low"])
+    st.markdown(f"**整體風險分數：** `{overall_summary['score']} / 100`")
 
     st.markdown("---")
     st.subheader("各條款詳細分析（含單條追問）")
 
-    llm = LLMClient()  # 追問用
-
     for i, r in enumerate(results, start=1):
-        title_line = get_clause_title(r["clause"])
-        title = f"第 {i} 條｜風險：{normalize_risk_level(r['risk_level'])}｜類型：{r['risk_type'] or '（未標示）'}｜{title_line}"
+        title = f"第 {i} 條｜風險：{r['risk_level']}｜類型：{r['risk_type'] or '（未標示）'}｜{r['_title']}"
 
         with st.expander(title, expanded=False):
-            st.markdown("**原文：**")
-            st.code(r["clause"], language="text")
-            st.markdown(f"**摘要：** {r['summary']}")
-            st.markdown(f"**風險等級：** {normalize_risk_level(r['risk_level'])}")
-            st.markdown(f"**風險類型：** {r['risk_type']}")
-            st.markdown(f"**風險原因：** {r['risk_reason']}")
-            st.markdown(f"**建議：** {r['suggestion']}")
-
-            #  A) 單條追問
-            st.markdown("### 針對本條追問")
-            q_key = f"clause_q_{i}"
-            ask_key = f"clause_ask_{i}"
-
-            user_q = st.text_area("輸入你的問題（例如：我該怎麼改這條？）", key=q_key, height=80)
-
-            colA, colB = st.columns([1, 5])
-            with colA:
-                do_ask = st.button("送出追問", key=ask_key)
-
-            if do_ask:
-                history = st.session_state["clause_qa"].get(i, [])
-                ans = llm.answer_followup_clause(
-                    clause_text=r["clause"],
-                    clause_analysis=r,
-                    question=user_q,
-                    history=history
-                )
-                history.append({"q": user_q, "a": ans})
-                st.session_state["clause_qa"][i] = history
-
-            # 顯示追問紀錄
-            history = st.session_state["clause_qa"].get(i, [])
-            if history:
-                st.markdown("#### 追問紀錄")
-                for t in history[-6:]:
-                    st.markdown(f"- **問：** {t['q']}\n\n  **答：** {t['a']}")
+            render_clause(i, r)
 
     st.markdown("---")
 
-    # 下載報告
-    report_md = create_markdown_report(results)
+    # 下載報告（分析完成時已產生好，rerun 不再重組）
     st.download_button(
         label="下載完整 Markdown 報告",
-        data=report_md,
+        data=summary["report_md"],
         file_name="analysis_report.md",
         mime="text/markdown",
     )
@@ -187,56 +389,7 @@ def main():
     st.subheader("聊天室（針對整份合約追問）")
 
     #  B) 聊天室 
-    # 組 top risky（最多 5 條）
-    top_risky = []
-    for idx, r in enumerate(results, start=1):
-        if normalize_risk_level(r["risk_level"]) == "高":
-            excerpt = r["clause"].replace("\n", " ")
-            if len(excerpt) > 120:
-                excerpt = excerpt[:120] + "..."
-            top_risky.append({
-                "idx": idx,
-                "title": get_clause_title(r["clause"]),
-                "risk_level": normalize_risk_level(r["risk_level"]),
-                "risk_type": r.get("risk_type", ""),
-                "risk_reason": r.get("risk_reason", ""),
-                "suggestion": r.get("suggestion", ""),
-                "clause_excerpt": excerpt,
-            })
-    top_risky = top_risky[:5]
-
-    overall_summary = {
-        "total": len(results),
-        "score": overall_score,
-        "high": high_count,
-        "mid": med_count,
-        "low": low_count
-    }
-
-    # 顯示聊天紀錄
-    for item in st.session_state["global_chat"][-10:]:
-        with st.chat_message("user"):
-            st.write(item["q"])
-        with st.chat_message("assistant"):
-            st.write(item["a"])
-
-    user_global_q = st.chat_input("輸入你對整份合約的問題（例如：我該優先改哪三條？）")
-
-    if user_global_q:
-        history = st.session_state["global_chat"]
-        ans = llm.answer_followup_global(
-            question=user_global_q,
-            overall_summary=overall_summary,
-            top_risky=top_risky,
-            history=history
-        )
-        history.append({"q": user_global_q, "a": ans})
-        st.session_state["global_chat"] = history
-
-        with st.chat_message("user"):
-            st.write(user_global_q)
-        with st.chat_message("assistant"):
-            st.write(ans)
+    render_global_chat(overall_summary, top_risky)
 
 
 if __name__ == "__main__":